@@ -1,65 +1,252 @@
 """Update README.md with top starred repositories for GitHub profile."""
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import functools
+import hashlib
+import heapq
+import json
+import mmap
 import os
 import re
-from typing import List, Dict
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 
+# orjson parses response bytes directly and much faster; fall back to stdlib
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 # Get token from environment (GitHub Actions provides GITHUB_TOKEN automatically)
 GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')
 GITHUB_API_BASE = 'https://api.github.com'
+GITHUB_GRAPHQL_URL = f'{GITHUB_API_BASE}/graphql'
+
+# Shared session: keep-alive connection pool, retries on transient errors,
+# and the token attached once for every request
+SESSION = requests.Session()
+SESSION.headers.update({
+    'Accept': 'application/vnd.github.v3+json',
+    'User-Agent': 'GitHub-Profile-Update'
+})
+if GITHUB_TOKEN:
+    SESSION.headers['Authorization'] = f'Bearer {GITHUB_TOKEN}'
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    # raise_on_status=False returns the last response once retries run out,
+    # so callers still see the status code instead of a RetryError
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        raise_on_status=False
+    )
+))
+
+# Top repos by stars, sorted server-side and limited to just the fields we use
+GRAPHQL_TOP_REPOS_FRAGMENT = '''
+fragment TopRepos on User {
+  repositories(first: $limit, privacy: PUBLIC, ownerAffiliations: OWNER,
+               orderBy: {field: STARGAZERS, direction: DESC}) {
+    nodes { name url stargazerCount owner { login } primaryLanguage { name } }
+  }
+}
+'''
+GRAPHQL_USER_QUERY = '''
+query($login: String!, $limit: Int!) {
+  owner: user(login: $login) { ...TopRepos }
+}
+''' + GRAPHQL_TOP_REPOS_FRAGMENT
+GRAPHQL_VIEWER_QUERY = '''
+query($limit: Int!) {
+  owner: viewer { ...TopRepos }
+}
+''' + GRAPHQL_TOP_REPOS_FRAGMENT
 
 # GitHub Stats API - using public service
 GITHUB_STATS_API_BASE = 'https://github-readme-stats.vercel.app'
 
+# Markdown stats card: (alt text, username, repo name, repo URL)
+# The API expects plain usernames and repo names in the URL
+CARD_TMPL = '[![%s](' + GITHUB_STATS_API_BASE + '/api/pin/?username=%s&repo=%s&theme=dark&hide_border=true)](%s)'
 
-def get_top_starred_repos(username: str = None, limit: int = 6) -> List[Dict]:
-    """Fetch top starred repositories for a user."""
-    headers = {
-        'Accept': 'application/vnd.github.v3+json',
-        'User-Agent': 'GitHub-Profile-Update'
-    }
+# A whole REPO_1..REPO_6 block; group 2 is the index, group 3 the current card
+# Uses [\s\S] to match any character including newlines (no DOTALL needed)
+# Bytes pattern so it can scan the README through a read-only mmap
+BLOCK_RE = re.compile(rb'(<!-- REPO_([1-6])_START -->)([\s\S]*?)(<!-- REPO_\2_END -->)')
+
+# Conditional-request cache: ETag and Link header per URL, plus the last 200 page
+# A 304 Not Modified has no body and doesn't count against the primary rate limit
+# Only the REST path uses it, i.e. runs without a token or when GraphQL fails
+ETAG_CACHE_FILE = '.etag_cache.json'
+BODY_CACHE_DIR = '.body_cache'
+
+# Extracts the page number of the rel="last" entry in a pagination Link header
+LINK_LAST_RE = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
+
+def load_etag_cache() -> Dict[str, Dict[str, str]]:
+    """Load the {url: {'etag', 'link'}} cache from the previous run."""
+    try:
+        with open(ETAG_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_etag_cache(cache: Dict[str, Dict[str, str]]):
+    """Persist the ETag cache for the next run."""
+    try:
+        with open(ETAG_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Warning: Could not write {ETAG_CACHE_FILE}: {e}")
+
+
+def get_top_starred_repos_graphql(username: str = None, limit: int = 6) -> Optional[List[Dict]]:
+    """Fetch top starred repositories with a single GraphQL query (requires token).
     
-    # Add token if available (improves rate limits, but not required for public repos)
-    if GITHUB_TOKEN:
-        headers['Authorization'] = f'Bearer {GITHUB_TOKEN}'
+    Returns None if the query fails so the caller can fall back to REST.
+    """
+    if username:
+        payload = {'query': GRAPHQL_USER_QUERY, 'variables': {'login': username, 'limit': limit}}
+    else:
+        payload = {'query': GRAPHQL_VIEWER_QUERY, 'variables': {'limit': limit}}
+    
+    response = SESSION.post(GITHUB_GRAPHQL_URL, json=payload, timeout=30)
+    if response.status_code != 200:
+        print(f"Error fetching repos via GraphQL: {response.status_code} - {response.text[:200]}")
+        return None
     
+    result = json_loads(response.content)
+    owner = (result.get('data') or {}).get('owner')
+    if result.get('errors') or not owner:
+        print(f"Error fetching repos via GraphQL: {str(result.get('errors'))[:200]}")
+        return None
+    
+    # Map nodes to the REST shape expected by update_readme
+    return [
+        {
+            'name': node['name'],
+            'html_url': node['url'],
+            'owner': {'login': node['owner']['login']},
+            'stargazers_count': node['stargazerCount'],
+            'language': (node.get('primaryLanguage') or {}).get('name'),
+        }
+        for node in owner['repositories']['nodes']
+    ]
+
+
+def get_top_starred_repos(username: str = None, limit: int = 6) -> List[Dict]:
+    """Fetch top starred repositories for a user."""
     # If no username provided, get authenticated user's repos (requires token)
+    query = ''
     if username:
         endpoint = f'/users/{username}/repos'
     else:
         if not GITHUB_TOKEN:
             raise ValueError("GITHUB_TOKEN is required when username is not provided")
+        # Same repos /users/{username}/repos lists: public ones the user owns
         endpoint = '/user/repos'
+        query = 'visibility=public&affiliation=owner&'
     
-    # Get all repos, sorted by stars
-    repos = []
-    page = 1
+    # GraphQL sorts by stars server-side and returns only the top repos
+    if GITHUB_TOKEN:
+        repos = get_top_starred_repos_graphql(username, limit)
+        if repos is not None:
+            return repos
+        print("Falling back to REST pagination")
+    
+    # REST fallback: paginate the repos endpoint and pick the top repos locally
     per_page = 100
     
-    while True:
-        url = f"{GITHUB_API_BASE}{endpoint}?sort=stars&direction=desc&per_page={per_page}&page={page}"
-        response = requests.get(url, headers=headers, timeout=30)
+    def url_for(page: int) -> str:
+        return f"{GITHUB_API_BASE}{endpoint}?{query}sort=stars&direction=desc&per_page={per_page}&page={page}"
+    
+    etag_cache = load_etag_cache()
+    os.makedirs(BODY_CACHE_DIR, exist_ok=True)
+    
+    def fetch_page(page: int) -> Tuple[Optional[List[Dict]], str]:
+        """Fetch one page, revalidating the cached copy with If-None-Match."""
+        url = url_for(page)
+        body_file = os.path.join(BODY_CACHE_DIR, f"{hashlib.sha1(url.encode()).hexdigest()}.json")
+        cached = etag_cache.get(url)
+        
+        request_headers = {}
+        if cached and os.path.exists(body_file):
+            request_headers['If-None-Match'] = cached['etag']
+        
+        response = SESSION.get(url, headers=request_headers, timeout=30)
+        
+        # Unchanged since last run - reuse the stored body. A 304 isn't required
+        # to repeat the Link header, so only fall back to the cached one
+        if response.status_code == 304:
+            with open(body_file, 'rb') as f:
+                return json_loads(f.read()), response.headers.get('Link') or cached.get('link', '')
         
         if response.status_code != 200:
-            print(f"Error fetching repos: {response.status_code} - {response.text[:200]}")
-            break
-            
-        page_repos = response.json()
-        if not page_repos:
-            break
-            
-        repos.extend(page_repos)
+            print(f"Error fetching repos page {page}: {response.status_code} - {response.text[:200]}")
+            return None, ''
         
-        # If we got less than per_page, we're done
-        if len(page_repos) < per_page:
-            break
-            
-        page += 1
+        # Keep only the fields we use so the full per-repo dicts can be freed
+        page_repos = [
+            {
+                'name': r['name'],
+                'html_url': r['html_url'],
+                'owner': {'login': r['owner']['login']},
+                'stargazers_count': r['stargazers_count'],
+                'language': r.get('language'),
+            }
+            for r in json_loads(response.content)
+        ]
+        
+        link = response.headers.get('Link', '')
+        etag = response.headers.get('ETag')
+        if etag:
+            with open(body_file, 'w', encoding='utf-8') as f:
+                json.dump(page_repos, f)
+            etag_cache[url] = {'etag': etag, 'link': link}
+        return page_repos, link
+    
+    # First page tells us how many pages there are via the Link header
+    repos, link = fetch_page(1)
+    if repos is None:
+        return []
+    
+    match = LINK_LAST_RE.search(link)
+    last_page = int(match.group(1)) if match else 1
+    
+    # Fetch the remaining pages concurrently
+    pages = [repos]
+    if last_page > 1:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for page_repos, _ in executor.map(fetch_page, range(2, last_page + 1)):
+                pages.append(page_repos or [])
+    
+    # A cached Link header can be stale if repos were added since it was
+    # stored, so keep going until a short page shows we've reached the end
+    while len(pages[-1]) == per_page:
+        page_repos, _ = fetch_page(len(pages) + 1)
+        pages.append(page_repos or [])
+    
+    repos = [repo for page_repos in pages for repo in page_repos]
+    
+    save_etag_cache(etag_cache)
     
-    # Sort by stars (descending) and return top repos
-    repos.sort(key=lambda x: x.get('stargazers_count', 0), reverse=True)
-    return repos[:limit]
+    # Select the top repos by stars (descending) without sorting the whole list
+    return heapq.nlargest(limit, repos, key=lambda x: x.get('stargazers_count', 0))
+
+
+@functools.lru_cache(maxsize=64)
+def render_card(repo_name: str, repo_url: str, username: str) -> bytes:
+    """Render the UTF-8 markdown stats card for one repository."""
+    # Create the markdown card with proper alt text (escape special chars in alt text)
+    alt_text = repo_name.replace('[', '\\[').replace(']', '\\]')
+    return (CARD_TMPL % (alt_text, username, repo_name, repo_url)).encode('utf-8')
 
 
 def update_readme(repos: List[Dict], readme_file: str = 'README.md'):
@@ -72,15 +259,14 @@ def update_readme(repos: List[Dict], readme_file: str = 'README.md'):
     target_file = None
     for candidate_file in [readme_file, 'profile.md']:
         try:
-            with open(candidate_file, 'r', encoding='utf-8') as f:
-                test_content = f.read()
+            with open(candidate_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
                 # Check if file has at least one REPO marker
-                if '<!-- REPO_1_START -->' in test_content:
+                if mm.find(b'<!-- REPO_1_START -->') != -1:
                     target_file = candidate_file
-                    content = test_content
                     print(f"Found markers in {candidate_file}")
                     break
-        except FileNotFoundError:
+        except (FileNotFoundError, ValueError):
+            # ValueError: empty files can't be mapped
             continue
     
     if not target_file:
@@ -96,52 +282,68 @@ def update_readme(repos: List[Dict], readme_file: str = 'README.md'):
     # Get current date for cache busting (changes daily to force refresh)
     cache_date = datetime.now().strftime('%Y%m%d')  # Format: YYYYMMDD
     
-    # Update each repository placeholder
-    updated = False
+    # Build the card for each repository placeholder
+    cards = []
     for i, repo in enumerate(repos[:6], 1):
         repo_name = repo.get('name', '')
         repo_url = repo.get('html_url', '')
         
         if not repo_name or not repo_url:
             print(f"Warning: Skipping REPO_{i} - missing name or URL")
+            cards.append(None)
             continue
         
-        # GitHub Stats API - public service
-        # Ensure username and repo_name don't have spaces or special encoding issues
-        # The API expects plain usernames and repo names in the URL
-        stats_url = f'{GITHUB_STATS_API_BASE}/api/pin/?username={username}&repo={repo_name}&theme=dark&hide_border=true'
-        
-        # Create the markdown card with proper alt text (escape special chars in alt text)
-        alt_text = repo_name.replace('[', '\\[').replace(']', '\\]')
-        card = f'[![{alt_text}]({stats_url})]({repo_url})'
-        
-        # Use regex to find and replace between the comment markers
-        # Pattern matches: START marker, whitespace/newlines, markdown card, whitespace/newlines, END marker
-        # Uses [\s\S] to match any character including newlines (more reliable than . with DOTALL)
-        pattern = rf'(<!-- REPO_{i}_START -->)[\s\S]*?\[!\[.*?\]\(.*?\)\]\(.*?\)[\s\S]*?(<!-- REPO_{i}_END -->)'
-        replacement = rf'\1\n{card}\n\2'
-        new_content = re.sub(pattern, replacement, content)
-        
-        if new_content != content:
-            content = new_content
-            updated = True
-            print(f"✅ Updated REPO_{i}: {repo_name}")
+        cards.append(render_card(repo_name, repo_url, username))
+    
+    # Substitute every block in one regex pass over a read-only mmap of the file
+    matched = set()
+    changed = set()
+    
+    def repl(m):
+        i = int(m.group(2))
+        matched.add(i)
+        card = cards[i - 1] if i <= len(cards) else None
+        if card is None or m.group(3) == b'\n' + card + b'\n':
+            return m.group(0)
+        changed.add(i)
+        return m.group(1) + b'\n' + card + b'\n' + m.group(4)
+    
+    try:
+        with open(target_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content = BLOCK_RE.sub(repl, mm)
+    except Exception as e:
+        print(f"Error reading {target_file}: {e}")
+        return False
+    
+    for i, repo in enumerate(repos[:6], 1):
+        if cards[i - 1] is None:
+            continue
+        if i in changed:
+            print(f"✅ Updated REPO_{i}: {repo['name']}")
+        elif i in matched:
+            print(f"REPO_{i} already up to date: {repo['name']}")
         else:
             print(f"⚠️  No match found for REPO_{i} markers in {target_file}")
     
-    # Write updated content
-    if updated:
-        try:
-            with open(target_file, 'w', encoding='utf-8') as f:
-                f.write(content)
-            print(f"✅ Successfully updated {target_file}")
-            return True
-        except Exception as e:
-            print(f"Error writing to {target_file}: {e}")
-            return False
-    else:
+    if not changed:
         print(f"No changes detected in {target_file}")
         return False
+    
+    # Write to a temp file and atomically swap it in
+    tmp_file = f'{target_file}.tmp'
+    try:
+        with open(tmp_file, 'wb') as out:
+            out.write(content)
+        # Keep the original file's permissions across the swap
+        shutil.copymode(target_file, tmp_file)
+        os.replace(tmp_file, target_file)
+        print(f"✅ Successfully updated {target_file}")
+        return True
+    except Exception as e:
+        print(f"Error writing to {target_file}: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
 
 
 def get_username() -> str:
@@ -149,15 +351,9 @@ def get_username() -> str:
     if not GITHUB_TOKEN:
         return ''
     
-    headers = {
-        'Authorization': f'Bearer {GITHUB_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-Agent': 'GitHub-Profile-Update'
-    }
-    
-    response = requests.get(f"{GITHUB_API_BASE}/user", headers=headers, timeout=30)
+    response = SESSION.get(f"{GITHUB_API_BASE}/user", timeout=30)
     if response.status_code == 200:
-        return response.json().get('login', '')
+        return json_loads(response.content).get('login', '')
     return ''
 
 
@@ -167,17 +363,28 @@ if __name__ == '__main__':
     print("Fetching top starred repositories...")
     
     # Try to get username from environment (GitHub Actions provides REPO_OWNER)
-    # Otherwise try to get from authenticated user
-    username = os.getenv('REPO_OWNER') or get_username()
+    username = os.getenv('REPO_OWNER')
+    if username:
+        print(f"Fetching repos for: {username}")
+        
+        # Use public API endpoint with username
+        repos = get_top_starred_repos(username=username, limit=6)
+    elif GITHUB_TOKEN:
+        # Otherwise look up the authenticated user while fetching their repos;
+        # the repo query doesn't need the login, so both requests overlap
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            username_future = executor.submit(get_username)
+            repos_future = executor.submit(get_top_starred_repos, limit=6)
+            username = username_future.result()
+            repos = repos_future.result()
+        
+        if username:
+            print(f"Fetched repos for: {username}")
     
     if not username:
         print("Error: Could not determine username")
         sys.exit(1)
     
-    print(f"Fetching repos for: {username}")
-    
-    # Use public API endpoint with username
-    repos = get_top_starred_repos(username=username, limit=6)
     print(f"Found {len(repos)} repositories")
     
     # Display top repos